@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 """Activation extraction system for vLLM inference."""
 
-import threading
+import pickle
 
 import torch
 
+__all__ = [
+    "ActivationExtractor",
+    "Probe",
+    "compute_probe",
+    "stack_activations",
+    "quantize_probe_weights",
+    "load_probe_from_file",
+]
+
 # Lazy import to avoid loading vLLM modules before model initialization
 # This prevents issues with vLLM's registry subprocess mechanism
 _ActivationStore = None
@@ -12,73 +21,432 @@ _ActivationHookManager = None
 
 
 def _lazy_import_activation_hooks():
-    """Lazy import of activation hooks to avoid premature vLLM module loading."""
+    """
+    Lazy import of activation hooks to avoid premature vLLM module loading.
+    Returns (TensorActivationStore, ActivationHookManager), where TensorActivationStore subclasses the fork's
+    ActivationStore so any of its methods not overridden here are inherited.
+    """
     global _ActivationStore, _ActivationHookManager
     if _ActivationStore is None or _ActivationHookManager is None:
         # Use importlib to handle the import robustly with the shim package
         # The shim re-exports attributes but submodule paths should still resolve
         import importlib
         module = importlib.import_module("vllm.v1.worker.activation_hooks")
-        _ActivationStore = module.ActivationStore
+        
+        class TensorActivationStore(_TensorActivationStoreMixin, module.ActivationStore):
+            """vLLM ActivationStore backed by preallocated per-(request_id, layer) tensors."""
+        
+        _ActivationStore = TensorActivationStore
         _ActivationHookManager = module.ActivationHookManager
     return _ActivationStore, _ActivationHookManager
 
 
+def _num_layers(model):
+    """Number of transformer layers in a model, or None if its layer list can't be found."""
+    language_model = getattr(model, "language_model", None)
+    # Decoder-only models keep layers on model.model; multimodal ones (e.g. Gemma 3) wrap that in language_model
+    for inner in (getattr(model, "model", None), getattr(language_model, "model", None), model):
+        layers = getattr(inner, "layers", None)
+        if layers is not None:
+            return len(layers)
+    return None
+
+
+def _compiled_by_vllm(model):
+    """Whether vLLM has already wrapped the model (or one of its submodules) in its own torch.compile."""
+    for module in model.modules():
+        # torch.compile'd modules (OptimizedModule) wrap the original as _orig_mod
+        if hasattr(module, "_orig_mod"):
+            return True
+        # Modules decorated with vLLM's @support_torch_compile carry compiled_callable unless compilation is off
+        if hasattr(module, "compiled_callable") and not getattr(module, "do_not_compile", False):
+            return True
+    return False
+
+
+def _compile_with_eager_fallback(forward, activation_store):
+    """
+    Wrap forward with torch.compile, reverting to the eager forward if compilation or a compiled call fails.
+    The default mode is used: reduce-overhead would capture CUDA graphs, which the Python-side hooks can't run in.
+    """
+    compiled = torch.compile(forward, dynamic=True)
+    current = [compiled]
+    
+    def wrapped(*args, **kwargs):
+        if current[0] is forward:
+            return forward(*args, **kwargs)
+        checkpoint = activation_store.checkpoint()
+        try:
+            return current[0](*args, **kwargs)
+        except Exception as e:
+            # Some shapes fail (or OOM) under inductor; stay eager from here on.
+            # Hooks may already have stored rows for this step, drop them so the eager re-run doesn't duplicate them
+            print(f"Warning: torch.compile failed, falling back to eager forward: {e}")
+            activation_store.rollback(checkpoint)
+            current[0] = forward
+            return forward(*args, **kwargs)
+    
+    return wrapped
+
+
+class _TensorActivationStoreMixin:
+    """
+    Activation storage backed by one preallocated [capacity, hidden] tensor per (request_id, layer).
+    Mixed into the fork's ActivationStore by _lazy_import_activation_hooks, overriding its storage and lookups.
+    The hooks are expected to hand over one [hidden] row per token position through store_activation.
+    Request IDs can be any hashable; ModelHandler uses integers.
+    With a copy_stream, buffers live in pinned host memory and are filled by async copies on that stream.
+    """
+    
+    def __init__(self, max_tokens=256, dtype=None, copy_stream=None):
+        """
+        Initialize the store. max_tokens is the initial row capacity of each buffer.
+        dtype is the storage dtype (e.g. torch.float16), defaulting to the dtype of the captured activations.
+        copy_stream is a CUDA stream used to offload activations to pinned CPU buffers.
+        """
+        super().__init__()
+        self.max_tokens = max_tokens
+        self.dtype = dtype
+        self.copy_stream = copy_stream
+        # (layer, position) to capture exclusively, or None to capture everything the hooks hand over
+        self.capture_filter = None
+        # (request_id, layer) -> [capacity, hidden] activation buffer
+        self._buffers = {}
+        # (request_id, layer) -> int32 [capacity] token position of each buffer row
+        self._positions = {}
+        # (request_id, layer) -> number of rows written so far
+        self._counts = {}
+        # (request_id, layer) -> CUDA event recorded after the latest offload copy
+        self._events = {}
+    
+    def _empty(self, shape, device, dtype):
+        """Allocate an uninitialised buffer, in pinned host memory when offloading."""
+        if self.copy_stream is not None:
+            return torch.empty(shape, dtype=dtype, device="cpu", pin_memory=True)
+        return torch.empty(shape, dtype=dtype, device=device)
+    
+    # Store bookkeeping changes on every call (row counts, positions, first-use allocation), so it is kept out
+    # of any compiled graph: tracing it would recompile each decode step or graph-break on every layer
+    @torch.compiler.disable
+    def _allocate(self, key, activation):
+        """Allocate the buffers for a (request_id, layer) pair from its first activation."""
+        # A capture filter keeps a single row per (request_id, layer)
+        capacity = 1 if self.capture_filter is not None else max(self.max_tokens, 1)
+        buffer = self._empty(
+            (capacity, activation.shape[-1]), activation.device, self.dtype or activation.dtype
+        )
+        self._buffers[key] = buffer
+        self._positions[key] = torch.empty(capacity, dtype=torch.int32)
+        self._counts[key] = 0
+        return buffer
+    
+    @torch.compiler.disable
+    def _grow(self, key):
+        """Double the capacity of a full buffer (prompt tokens also count towards the positions)."""
+        self._wait(key)
+        old_buffer = self._buffers[key]
+        old_positions = self._positions[key]
+        capacity = old_buffer.shape[0] * 2
+        buffer = self._empty((capacity, old_buffer.shape[1]), old_buffer.device, old_buffer.dtype)
+        buffer[:old_buffer.shape[0]].copy_(old_buffer)
+        positions = old_positions.new_empty(capacity)
+        positions[:old_positions.shape[0]].copy_(old_positions)
+        self._buffers[key] = buffer
+        self._positions[key] = positions
+        return buffer
+    
+    @torch.compiler.disable
+    def store_activation(self, request_id, layer_idx, position, activation):
+        """Store the activation of one token position by copying it into the next buffer row."""
+        capture_filter = self.capture_filter
+        if capture_filter is not None and (layer_idx, position) != capture_filter:
+            return
+        # Fail loudly if the hooks don't hand over a single [hidden] row per token position
+        hidden_size = activation.shape[-1]
+        if activation.numel() != hidden_size:
+            raise ValueError(
+                f"store_activation expects one [hidden] row per token position, got shape {tuple(activation.shape)}"
+            )
+        key = (request_id, layer_idx)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._allocate(key, activation)
+        if hidden_size != buffer.shape[1]:
+            raise ValueError(
+                f"Activation hidden size {hidden_size} doesn't match the buffer for layer {layer_idx} "
+                f"({buffer.shape[1]})"
+            )
+        count = self._counts[key]
+        if count >= buffer.shape[0]:
+            buffer = self._grow(key)
+        if self.copy_stream is not None:
+            # Stage a private device copy on the compute stream first: vLLM updates hidden states in place
+            # (e.g. fused residual add + RMSNorm), so the side stream must not read the hooked tensor itself
+            staging = activation.detach().reshape(-1).to(buffer.dtype, copy=True)
+            # Copy the staged row to the pinned buffer on the side stream so the transfer overlaps the next decode step
+            self.copy_stream.wait_stream(torch.cuda.current_stream(activation.device))
+            with torch.cuda.stream(self.copy_stream):
+                buffer[count].copy_(staging, non_blocking=True)
+            # Keep the staging memory alive until the copy stream is done with it
+            staging.record_stream(self.copy_stream)
+            event = self._events.get(key)
+            if event is None:
+                event = self._events[key] = torch.cuda.Event()
+            event.record(self.copy_stream)
+        else:
+            # A single copy_ does the detach, any cast to the storage dtype and the write into the row
+            buffer[count].copy_(activation.detach().reshape(-1), non_blocking=True)
+        self._positions[key][count] = position
+        self._counts[key] = count + 1
+    
+    def _wait(self, key):
+        """Block until the pending offload copies for a (request_id, layer) pair have landed."""
+        event = self._events.get(key)
+        if event is not None:
+            event.synchronize()
+    
+    def _find_row(self, key, position):
+        """Find the buffer row holding a token position, or None."""
+        count = self._counts[key]
+        positions = self._positions[key]
+        # Positions are normally captured in order, so the row index is the position itself
+        if position < count and positions[position] == position:
+            return position
+        rows = (positions[:count] == position).nonzero()
+        if rows.numel() == 0:
+            return None
+        return int(rows[0])
+    
+    def get_activation(self, request_id, layer_idx, position):
+        """Get the activation for a token position (a view into the buffer), or None."""
+        key = (request_id, layer_idx)
+        if key not in self._buffers:
+            return None
+        row = self._find_row(key, position)
+        if row is None:
+            return None
+        self._wait(key)
+        return self._buffers[key][row]
+    
+    def get_activations_stacked(self, request_id, layer_idx):
+        """Get all activations for a request and layer as one [N, D] view, in capture order."""
+        key = (request_id, layer_idx)
+        if key not in self._buffers:
+            return None
+        self._wait(key)
+        return self._buffers[key][:self._counts[key]]
+    
+    def get_layers_for_request(self, request_id):
+        """Get the set of layers with stored activations for a request."""
+        return {layer for (req, layer) in self._buffers if req == request_id}
+    
+    def get_positions_for_request(self, request_id):
+        """Get the set of token positions with stored activations for a request."""
+        positions = set()
+        for key, count in self._counts.items():
+            if key[0] == request_id:
+                positions.update(self._positions[key][:count].tolist())
+        return positions
+    
+    def get_stats(self):
+        """Get summary statistics for the stored activations."""
+        requests = list(dict.fromkeys(req for (req, _) in self._buffers))
+        return {
+            "num_requests": len(requests),
+            "requests": requests,
+            "num_activations": sum(self._counts.values()),
+            "allocated_bytes": sum(b.numel() * b.element_size() for b in self._buffers.values()),
+        }
+    
+    def checkpoint(self):
+        """Snapshot of how many rows each buffer holds, for rolling back a failed forward step."""
+        return dict(self._counts)
+    
+    def rollback(self, checkpoint):
+        """Discard every row stored since checkpoint() was taken."""
+        for key in list(self._buffers):
+            if key in checkpoint:
+                self._counts[key] = checkpoint[key]
+            else:
+                del self._buffers[key]
+                del self._positions[key]
+                del self._counts[key]
+                self._events.pop(key, None)
+    
+    def clear_request(self, request_id):
+        """Release the buffers of a single request."""
+        for key in [key for key in self._buffers if key[0] == request_id]:
+            self._wait(key)
+            del self._buffers[key]
+            del self._positions[key]
+            del self._counts[key]
+            self._events.pop(key, None)
+    
+    def clear_all(self):
+        """Release all buffers."""
+        if self.copy_stream is not None:
+            self.copy_stream.synchronize()
+        self._buffers.clear()
+        self._positions.clear()
+        self._counts.clear()
+        self._events.clear()
+
+
 class ActivationExtractor:
     """
     Main interface for activation extraction during inference.
     Stores activations for use in probe computation.
+    
+    Setup and teardown (register_model, cleanup) follow a single-writer invariant: they are called from the
+    thread that owns the model, never concurrently with generation, so no lock is taken.
+    The request context lives in the shared hook manager, so set_request_context is single-threaded too:
+    concurrent generations from several threads would overwrite each other's context.
     """
     
-    def __init__(self, extract_layers, enabled=True):
-        """Initialize the activation extractor"""
+    __slots__ = (
+        "enabled", "extract_layers", "capture_dtype", "use_compile", "activation_store", "hook_manager",
+        "_copy_stream", "_model", "_capture_filter",
+    )
+    
+    def __init__(self, extract_layers, enabled=True, capture_dtype=None, offload_to_cpu=False, use_compile=False):
+        """
+        Initialize the activation extractor
+        
+        extract_layers: non-empty list of layer indices to capture, required when enabled.
+        capture_dtype: dtype activations are stored in (e.g. torch.float16), cast as part of the capture copy.
+        offload_to_cpu: copy activations to pinned CPU buffers on a dedicated CUDA stream (CUDA only).
+        use_compile: experimental and unbenchmarked. Wrap the model forward in torch.compile once hooks are
+            registered, falling back to eager on failure. Skipped if vLLM already compiled the model (it does unless
+            enforce_eager is set). Not supported together with offload_to_cpu.
+        Hooks are registered on the eager modules; if the model is scripted or compiled, register it first.
+        """
+        # Capturing every layer copies the full residual stream of each block per token, so require a choice
+        if enabled and not extract_layers:
+            raise ValueError("extract_layers must be a non-empty list of ints")
+        # The side-stream copies and event bookkeeping of offloading can't be traced into a compiled forward
+        if use_compile and offload_to_cpu:
+            raise ValueError("use_compile can't be combined with offload_to_cpu")
         self.enabled = enabled
         self.extract_layers = extract_layers
+        self.capture_dtype = capture_dtype
+        self.use_compile = use_compile
+        # Side stream for async device-to-host activation copies
+        self._copy_stream = None
+        if offload_to_cpu and torch.cuda.is_available():
+            self._copy_stream = torch.cuda.Stream()
         # Don't create ActivationStore here - delay until needed
         self.activation_store = None
         self.hook_manager = None
         self._model = None
-        self._lock = threading.Lock()
+        # (layer, position) set by set_capture_filter, or None
+        self._capture_filter = None
     
     def register_model(self, model):
         """Register hooks on a model for activation extraction."""
         if not self.enabled:
             return
         
-        # Lazy import and initialization of activation store
-        ActivationStore, ActivationHookManager = _lazy_import_activation_hooks()
+        # Already registered on this model, nothing to do
+        if self.hook_manager is not None and self._model is model:
+            return
+        
+        # Validate layer indices up front rather than installing hooks that never match a layer.
+        # Done before touching the current registration, so a failure leaves it intact
+        extract_layers = tuple(self.extract_layers)
+        num_layers = _num_layers(model)
+        if num_layers is not None:
+            valid_layers = tuple(layer for layer in extract_layers if 0 <= layer < num_layers)
+            if not valid_layers:
+                raise ValueError(
+                    f"None of extract_layers {list(extract_layers)} exist in the model ({num_layers} layers)"
+                )
+            if len(valid_layers) < len(extract_layers):
+                skipped = sorted(set(extract_layers) - set(valid_layers))
+                print(f"Warning: Skipping layers {skipped} not present in the model ({num_layers} layers)")
+            extract_layers = valid_layers
         
-        with self._lock:
-            # Initialize activation store if not already done
-            if self.activation_store is None:
-                self.activation_store = ActivationStore()
-            
-            if self.hook_manager is not None:
-                self.hook_manager.remove_hooks()
-            
-            self._model = model
-            self.hook_manager = ActivationHookManager(
-                activation_store=self.activation_store,
-                extract_layers=self.extract_layers,
+        # Lazy import of the activation store and hook manager
+        TensorActivationStore, ActivationHookManager = _lazy_import_activation_hooks()
+        
+        # Initialize activation store if not already done
+        if self.activation_store is None:
+            self.activation_store = TensorActivationStore(
+                dtype=self.capture_dtype, copy_stream=self._copy_stream
             )
-            self.hook_manager.register_hooks(model)
+        
+        # Tear down the previous registration, unpublishing it so nothing forwards to a dead hook manager
+        old_hook_manager, self.hook_manager = self.hook_manager, None
+        if old_hook_manager is not None:
+            old_hook_manager.remove_hooks()
+        self._restore_forward()
+        
+        self._model = model
+        hook_manager = ActivationHookManager(
+            activation_store=self.activation_store,
+            extract_layers=extract_layers,
+        )
+        hook_manager.register_hooks(model)
+        
+        # Compile after the hooks are in place; the store writes they make run eagerly outside the graph
+        if self.use_compile:
+            if _compiled_by_vllm(model):
+                print("Warning: Model is already compiled by vLLM (run with enforce_eager), skipping torch.compile")
+            else:
+                model.forward = _compile_with_eager_fallback(model.forward, self.activation_store)
+        
+        # Publish the fully set up hook manager last, so readers never see a half-registered one
+        self.hook_manager = hook_manager
     
-    def set_request_context(self, request_ids, token_positions=None):
-        """Set the current request context for activation extraction."""
-        if self.hook_manager is not None:
-            self.hook_manager.set_request_context(request_ids, token_positions)
+    def _restore_forward(self):
+        """Drop a compiled forward installed by register_model, restoring the model's own forward."""
+        if self._model is not None and "forward" in vars(self._model):
+            del self._model.forward
+    
+    def set_request_context(self, request_ids, token_positions=None, max_tokens=None):
+        """
+        Set the current request context for activation extraction.
+        token_positions restricts the positions the hooks capture, as one list of positions per request ID.
+        max_tokens sizes the activation buffers allocated for these requests.
+        Not thread-safe: the hooks read a single shared context.
+        """
+        if max_tokens is not None:
+            self.get_activation_store().max_tokens = max_tokens
+        # Hand a capture filter's position to the hook manager, so other positions are skipped before the hook copies
+        if token_positions is None and self._capture_filter is not None:
+            position = self._capture_filter[1]
+            token_positions = [[position] for _ in request_ids]
+        hook_manager = self.hook_manager
+        if hook_manager is not None:
+            hook_manager.set_request_context(request_ids, token_positions)
+    
+    def set_capture_filter(self, layer, position):
+        """
+        Only capture the activation of one layer at one token position. Takes effect from the next
+        set_request_context, which passes the position to the hook manager as token_positions so the hooks skip
+        other positions before copying anything; the store also drops any other (layer, position) it is handed.
+        Pass None to capture everything.
+        """
+        capture_filter = None if layer is None else (layer, position)
+        self._capture_filter = capture_filter
+        self.get_activation_store().capture_filter = capture_filter
     
     def clear_request_context(self):
         """Clear the current request context."""
-        if self.hook_manager is not None:
-            self.hook_manager.clear_request_context()
+        hook_manager = self.hook_manager
+        if hook_manager is not None:
+            hook_manager.clear_request_context()
+        # End of generation: order later work on the compute stream after the pending offload copies
+        if self._copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._copy_stream)
     
     def get_activation_store(self):
         """Get the activation store for probe computation."""
         # Lazy import and initialization if needed
         if self.activation_store is None:
-            ActivationStore, _ = _lazy_import_activation_hooks()
-            self.activation_store = ActivationStore()
+            TensorActivationStore, _ = _lazy_import_activation_hooks()
+            self.activation_store = TensorActivationStore(
+                dtype=self.capture_dtype, copy_stream=self._copy_stream
+            )
         return self.activation_store
     
     def clear_activations(self, request_id=None):
@@ -92,13 +460,14 @@ class ActivationExtractor:
     
     def cleanup(self):
         """Remove hooks and cleanup resources."""
-        with self._lock:
-            if self.hook_manager is not None:
-                self.hook_manager.remove_hooks()
-                self.hook_manager = None
-            if self.activation_store is not None:
-                self.activation_store.clear_all()
-            self._model = None
+        # Unpublish the hook manager first so concurrent callers stop forwarding to it
+        hook_manager, self.hook_manager = self.hook_manager, None
+        if hook_manager is not None:
+            hook_manager.remove_hooks()
+        if self.activation_store is not None:
+            self.activation_store.clear_all()
+        self._restore_forward()
+        self._model = None
     
     def __enter__(self):
         """Context manager entry."""
@@ -109,25 +478,196 @@ class ActivationExtractor:
         self.cleanup()
 
 
-def compute_probe(activation, probe_weights, probe_bias=None):
-    """Compute probe output (dot product) for an activation."""
-    if probe_weights.dim() == 1:
-        # Single output probe
-        output = torch.dot(activation, probe_weights)
-        if probe_bias is not None:
-            output = output + probe_bias
+class Probe:
+    """
+    Linear probe loaded once from file.
+    Device/dtype copies of the weights are cached in GEMM-ready layout.
+    With quantize=True the weights are also kept as per-row int8 for an int8 GEMM path.
+    """
+    
+    def __init__(self, path, quantize=False):
+        """Load the probe weights and bias onto the CPU"""
+        self.path = path
+        self.weights, self.bias = load_probe_from_file(path)
+        # Single output probes are stored as [D], multi-class probes as [C, D]
+        self.single_output = self.weights.dim() == 1
+        self.quantize = quantize
+        self._cache = {}
+        self._int8_cache = {}
+        if quantize:
+            self.weights_int8, self.scales = quantize_probe_weights(self._weights_2d().float())
+    
+    @property
+    def shape(self):
+        """Shape of the probe weights as stored in the file."""
+        return self.weights.shape
+    
+    @property
+    def num_outputs(self):
+        """Number of probe outputs (C)."""
+        return self._weights_2d().shape[0]
+    
+    def _weights_2d(self):
+        """Probe weights in [C, D] layout."""
+        return self.weights.unsqueeze(0) if self.single_output else self.weights
+    
+    def _bias(self, device, dtype):
+        """Bias as a contiguous [C] tensor, zeros if the probe has none."""
+        if self.bias is not None:
+            return torch.as_tensor(self.bias).reshape(-1).to(device=device, dtype=dtype).contiguous()
+        # Zero bias so the GEMM can always go through torch.addmm
+        return torch.zeros(self.num_outputs, device=device, dtype=dtype)
+    
+    def to(self, device, dtype):
+        """Get (weights_t, bias) on a device/dtype, with weights_t contiguous in [D, C] layout."""
+        key = (device, dtype)
+        cached = self._cache.get(key)
+        if cached is None:
+            weights_t = self._weights_2d().t().to(device=device, dtype=dtype).contiguous()
+            cached = (weights_t, self._bias(device, dtype))
+            self._cache[key] = cached
+        return cached
+    
+    def to_int8(self, device):
+        """
+        Get (weights_int8_t, scales, bias) on a device for the int8 GEMM.
+        weights_int8_t is [D, C'] with C padded to a multiple of 8 as required by torch._int_mm.
+        """
+        cached = self._int8_cache.get(device)
+        if cached is None:
+            num_outputs = self.num_outputs
+            padded = -(-num_outputs // 8) * 8
+            weights_int8 = self.weights_int8
+            if padded != num_outputs:
+                weights_int8 = torch.cat(
+                    [weights_int8, weights_int8.new_zeros((padded - num_outputs, weights_int8.shape[1]))]
+                )
+            weights_int8_t = weights_int8.t().to(device).contiguous()
+            cached = (weights_int8_t, self.scales.to(device), self._bias(device, torch.float32))
+            self._int8_cache[device] = cached
+        return cached
+
+
+def quantize_probe_weights(weights):
+    """Symmetric per-row int8 quantization of [C, D] probe weights, returning (weights_int8, scales)."""
+    scales = weights.abs().amax(dim=1).clamp(min=1e-12) / 127
+    weights_int8 = (weights / scales[:, None]).round().clamp(-127, 127).to(torch.int8)
+    return weights_int8, scales
+
+
+def _int_mm_supported(activations_2d):
+    """Whether torch._int_mm can run the int8 probe GEMM for these activations."""
+    if not hasattr(torch, "_int_mm"):
+        return False
+    if activations_2d.device.type == "cuda":
+        # cuBLAS int8 GEMM needs more than 16 rows and an inner dimension divisible by 8
+        return activations_2d.shape[0] > 16 and activations_2d.shape[1] % 8 == 0
+    return activations_2d.device.type == "cpu"
+
+
+def _compute_probe_int8(activations_2d, probe):
+    """Int8 probe GEMM with per-token dynamic activation quantization."""
+    weights_int8_t, scales, bias = probe.to_int8(activations_2d.device)
+    activations_fp = activations_2d.float()
+    activation_scales = activations_fp.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127
+    activations_int8 = (activations_fp / activation_scales).round().clamp(-127, 127).to(torch.int8)
+    accumulated = torch._int_mm(activations_int8, weights_int8_t)[:, :probe.num_outputs]
+    output = torch.addcmul(bias, accumulated.float(), activation_scales * scales)
+    return output.to(activations_2d.dtype)
+
+
+def compute_probe(activations, probe_weights, probe_bias=None):
+    """
+    Compute probe outputs for a single activation [D] or stacked activations [N, D].
+    probe_weights may be a Probe, in which case probe_bias is ignored and the weights are used from the Probe's
+    cache on the activations' device. Raw tensors must already be on the same device as the activations.
+    """
+    if isinstance(probe_weights, Probe):
+        activations_2d = activations.unsqueeze(0) if activations.dim() == 1 else activations
+        output = None
+        if probe_weights.quantize and _int_mm_supported(activations_2d):
+            try:
+                output = _compute_probe_int8(activations_2d, probe_weights)
+            except RuntimeError:
+                # Int8 kernels are not available on every build, fall back to the floating point GEMM
+                output = None
+        if output is None:
+            weights_t, bias = probe_weights.to(activations.device, activations.dtype)
+            output = torch.addmm(bias, activations_2d, weights_t)
+        if probe_weights.single_output:
+            output = output.squeeze(1)
+        if activations.dim() == 1:
+            output = output.squeeze(0)
         return output
+    
+    # No implicit host/device round trips: raw weights must live where the activations do
+    if probe_weights.device != activations.device:
+        raise ValueError(
+            f"Probe weights are on {probe_weights.device} but activations are on {activations.device}; "
+            "move them to the activation device once (or pass a Probe, which caches per device)"
+        )
+    
+    # addmv/addmm need a tensor bias of the activations' dtype; checkpoints may hold a float or fp32 bias
+    if probe_bias is not None:
+        probe_bias = torch.as_tensor(probe_bias, dtype=activations.dtype, device=activations.device)
+    
+    if activations.dim() == 1:
+        # Single activation (kept for backward compatibility)
+        if probe_weights.dim() == 1:
+            # Single output probe
+            if probe_bias is not None:
+                # Bias fused into the matrix-vector product rather than a separate add
+                return torch.addmv(probe_bias, probe_weights.unsqueeze(0), activations).squeeze(0)
+            return torch.dot(activations, probe_weights)
+        else:
+            # Multi-class probe
+            if probe_bias is not None:
+                return torch.addmv(probe_bias, probe_weights, activations)
+            return torch.mv(probe_weights, activations)
+
+    # Stacked activations: one GEMM over all positions instead of one kernel per position
+    weights_2d = probe_weights.unsqueeze(0) if probe_weights.dim() == 1 else probe_weights
+    if probe_bias is not None:
+        output = torch.addmm(probe_bias, activations, weights_2d.t())
     else:
-        # Multi-class probe
-        output = torch.matmul(probe_weights, activation)
-        if probe_bias is not None:
-            output = output + probe_bias
-        return output
+        output = activations @ weights_2d.t()
+    if probe_weights.dim() == 1:
+        # Single output probe gives one value per position
+        output = output.squeeze(1)
+    return output
+
+
+def stack_activations(activation_store, request_id, layer):
+    """Stack all activations for a request and layer into one [N, D] tensor, ordered by token position."""
+    if hasattr(activation_store, "get_activations_stacked"):
+        # Already contiguous in the tensor-backed store, no copy needed
+        return activation_store.get_activations_stacked(request_id, layer)
+    positions = sorted(activation_store.get_positions_for_request(request_id))
+    activations = []
+    for position in positions:
+        activation = activation_store.get_activation(request_id, layer, position)
+        if activation is not None:
+            activations.append(activation)
+    if not activations:
+        return None
+    return torch.stack(activations)
 
 
 def load_probe_from_file(probe_path):
-    """Load a probe from a file."""
-    checkpoint = torch.load(probe_path, map_location="cpu")
+    """
+    Load a probe from a file.
+    Weights are memory-mapped rather than deserialised up front where the format allows:
+    .safetensors files, and torch.save files written with _use_new_zipfile_serialization=True (the default).
+    """
+    if str(probe_path).endswith(".safetensors"):
+        from safetensors.torch import load_file
+        checkpoint = load_file(probe_path, device="cpu")
+    else:
+        try:
+            checkpoint = torch.load(probe_path, map_location="cpu", mmap=True, weights_only=True)
+        except (TypeError, RuntimeError, pickle.UnpicklingError):
+            # Older PyTorch without mmap, legacy (non-zipfile) checkpoints, or pickles that aren't plain tensors
+            checkpoint = torch.load(probe_path, map_location="cpu")
     
     if isinstance(checkpoint, dict):
         weights = checkpoint.get("weight", checkpoint.get("weights"))
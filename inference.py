@@ -3,50 +3,133 @@
 
 # package imports 
 # import vllm
+import re
 from models import ModelHandler
-from activation_extraction import compute_probe, load_probe_from_file
+from activation_extraction import Probe, compute_probe, stack_activations
 import click
+import torch
+
+
+def parse_layer_spec(spec):
+    """Parse a layer spec such as '0,5,10-12' into a sorted tuple of unique layer indices."""
+    layers = set()
+    for token in spec.split(','):
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", token.strip())
+        if match is None:
+            raise ValueError(f"Invalid layer spec: {token.strip()!r}")
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) is not None else start
+        if end < start:
+            raise ValueError(f"Invalid layer range: {token.strip()!r}")
+        layers.update(range(start, end + 1))
+    return tuple(sorted(layers))
 
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help'], show_default=True))
 @click.option("--model-name", type=str, default="google/gemma-3-4b-it")
 @click.option("--prompt", type=str, default="Hello, how are you?")
+@click.option("--prompts-file", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="File with one prompt per line, generated as a single batch (overrides --prompt)")
 @click.option("--extract-activations", is_flag=True, default=False,
               help="Enable activation extraction during inference")
 @click.option("--extract-layers", type=str, default=None,
-              help="Comma-separated list of layer indices to extract activations from (e.g., '0,5,10'). "
-                   "If not specified and --extract-activations is set, extracts from all layers.")
+              help="Comma-separated layer indices and inclusive ranges to extract activations from "
+                   "(e.g., '0,5,10' or '0-79'). "
+                   "Defaults to --probe-layer when a probe is given; otherwise required with --extract-activations.")
+@click.option("--capture-dtype", type=click.Choice(["float16", "bfloat16", "float32"]), default=None,
+              help="dtype to store extracted activations in (defaults to the model dtype)")
+@click.option("--offload-activations", is_flag=True, default=False,
+              help="Copy extracted activations to pinned CPU memory asynchronously (CUDA only)")
+@click.option("--compile-model", is_flag=True, default=False,
+              help="Experimental, unbenchmarked: run vLLM eagerly and torch.compile the hooked model forward instead "
+                   "(falls back to eager on failure)")
+@click.option("--enable-context-caching/--disable-context-caching", default=None,
+              help="Reuse the KV cache for shared prompt prefixes (vLLM prefix caching). "
+                   "Prompts that share a prefix, such as a system prompt, skip recomputing it. "
+                   "On by default, and always off with --extract-activations.")
 @click.option("--probe-path", type=str, default=None,
               help="Path to probe weights file to compute probe outputs")
 @click.option("--probe-layer", type=int, default=None,
               help="Layer index to use for probe computation (required if --probe-path is set)")
-def main(model_name, prompt, extract_activations, extract_layers, probe_path, probe_layer):
+@click.option("--probe-position", type=int, default=None,
+              help="Only capture the probe layer at this token position (0 is the first prompt token, usually BOS, "
+                   "which is the same for every prompt). By default the probe is computed over every position.")
+@click.option("--quantize-probe", is_flag=True, default=False,
+              help="Quantize probe weights to int8 and compute probe outputs with an int8 GEMM where supported")
+def main(model_name, prompt, prompts_file, extract_activations, extract_layers, capture_dtype,
+         offload_activations, compile_model, enable_context_caching, probe_path, probe_layer, probe_position,
+         quantize_probe):
     """Run inference with optional activation extraction and probe computation."""
     
     # Parse extract_layers if provided
     extract_layers_list = None
     if extract_layers:
         try:
-            extract_layers_list = [int(x.strip()) for x in extract_layers.split(',')]
-        except ValueError:
-            click.echo("Error: --extract-layers must be comma-separated integers", err=True)
+            extract_layers_list = parse_layer_spec(extract_layers)
+        except ValueError as e:
+            click.echo(f"Error: --extract-layers must be comma-separated integers or ranges ({e})", err=True)
+            return
+    
+    # Read batched prompts if provided
+    prompts = [prompt]
+    if prompts_file:
+        with open(prompts_file) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+        if not prompts:
+            click.echo(f"Error: no prompts found in {prompts_file}", err=True)
             return
     
     # Validate probe options
     if probe_path and probe_layer is None:
         click.echo("Error: --probe-layer is required when --probe-path is set", err=True)
         return
+    if probe_position is not None and not (probe_path and extract_activations):
+        click.echo("Error: --probe-position requires --probe-path and --extract-activations", err=True)
+        return
+    
+    # Only the probe layer is needed for probing, so don't capture any others unless asked to
+    probe_only = bool(probe_path) and extract_activations and extract_layers_list is None
+    if probe_only:
+        extract_layers_list = (probe_layer,)
+    if extract_activations and not extract_layers_list:
+        click.echo("Error: --extract-layers is required with --extract-activations unless --probe-path is set",
+                   err=True)
+        return
+    
+    # Load the probe up front so its weights are prepared once, not per computation
+    probe = None
+    if probe_path:
+        try:
+            probe = Probe(probe_path, quantize=quantize_probe)
+        except Exception as e:
+            click.echo(f"Error loading probe from {probe_path}: {e}", err=True)
+            return
     
     # Initialize model with activation extraction if requested
     model = ModelHandler(
         model_name=model_name,
         extract_activations=extract_activations,
         extract_layers=extract_layers_list,
+        offload_activations=offload_activations,
+        capture_dtype=getattr(torch, capture_dtype) if capture_dtype else None,
+        enable_prefix_caching=enable_context_caching,
+        compile_model=compile_model,
     )
     
-    # Run generation
-    generated_text = model.generate(prompt=prompt)
-    print(f"Generated text: {generated_text}\n")
+    # Capture just the requested token position of the probe layer if asked to
+    if probe_position is not None:
+        model.activation_extractor.set_capture_filter(probe_layer, probe_position)
+    
+    # Run generation, batching all prompts into a single call
+    if probe_only:
+        # Probing only needs the activations, so skip detokenisation
+        generated_token_ids = model.generate_batch(prompts, return_text=False)
+        for token_ids in generated_token_ids:
+            print(f"Generated {len(token_ids)} tokens\n")
+    else:
+        generated_texts = model.generate_batch(prompts)
+        for generated_text in generated_texts:
+            print(f"Generated text: {generated_text}\n")
     
     # Handle activation extraction and probe computation
     if extract_activations:
@@ -55,9 +138,12 @@ def main(model_name, prompt, extract_activations, extract_layers, probe_path, pr
             stats = activation_store.get_stats()
             print(f"Activation extraction stats: {stats}")
             
-            # Show available layers and positions
-            if stats["num_requests"] > 0:
-                request_id = stats["requests"][0]
+            if probe is not None and probe_layer is not None:
+                print(f"\nLoaded probe from {probe_path}")
+                print(f"Probe weights shape: {probe.shape}")
+            
+            # Show available layers and positions for each request
+            for request_id in stats["requests"]:
                 layers = activation_store.get_layers_for_request(request_id)
                 positions = activation_store.get_positions_for_request(request_id)
                 print(f"Request {request_id}:")
@@ -65,32 +151,23 @@ def main(model_name, prompt, extract_activations, extract_layers, probe_path, pr
                 print(f"  Available positions: {sorted(positions)}")
                 
                 # Compute probe if requested
-                if probe_path and probe_layer is not None:
+                if probe is not None and probe_layer is not None:
                     try:
-                        probe_weights, probe_bias = load_probe_from_file(probe_path)
-                        print(f"\nLoaded probe from {probe_path}")
-                        print(f"Probe weights shape: {probe_weights.shape}")
+                        # Gather activations for every position of the probe layer into a single
+                        # tensor so the probe runs as one GEMM rather than once per position
+                        activations = stack_activations(activation_store, request_id, probe_layer)
                         
-                        # Get activation for the specified layer
-                        # Use the first available position
-                        if positions:
-                            position = sorted(positions)[0]
-                            activation = activation_store.get_activation(
-                                request_id, probe_layer, position
-                            )
-                            
-                            if activation is not None:
-                                probe_output = compute_probe(activation, probe_weights, probe_bias)
-                                print(f"\nProbe output for layer {probe_layer}, position {position}:")
-                                print(f"  Value: {probe_output.item() if probe_output.numel() == 1 else probe_output}")
-                            else:
-                                print(f"\nWarning: No activation found for layer {probe_layer}, position {position}")
+                        if activations is not None:
+                            probe_outputs = compute_probe(activations, probe)
+                            print(f"\nProbe outputs for layer {probe_layer} over {activations.shape[0]} positions:")
+                            print(f"  Values: {probe_outputs}")
                         else:
-                            print("\nWarning: No token positions available for probe computation")
+                            print(f"\nWarning: No activations found for layer {probe_layer}")
                     except Exception as e:
                         print(f"\nError computing probe: {e}")
-                else:
-                    print("\nTip: Use --probe-path and --probe-layer to compute probe outputs")
+            
+            if stats["num_requests"] > 0 and probe is None:
+                print("\nTip: Use --probe-path and --probe-layer to compute probe outputs")
         else:
             print("Warning: Activation extraction was requested but activation store is not available")
 
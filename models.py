@@ -5,6 +5,7 @@ Smart model downloading and inference methods, optimising available hardware
 """
 
 # package imports
+import itertools
 import os
 import sys
 # from vllm import LLM, SamplingParams # lazily imported
@@ -12,6 +13,50 @@ import click # for CLI
 from dotenv import load_dotenv
 import torch # for device checking - native dependency of vLLM
 
+
+def _model_via_get_model(engine):
+    """get_model() method (available in recent versions, the recommended approach going forward)"""
+    return engine.get_model()
+
+
+def _model_via_driver_worker(engine):
+    """legacy V0 engine path through model_executor.driver_worker"""
+    return engine.model_executor.driver_worker.model_runner.model
+
+
+def _model_via_workers(engine):
+    """legacy V0 engine path through the model_executor.workers array"""
+    workers = engine.model_executor.workers
+    if not workers:
+        return None
+    return workers[0].model_runner.model
+
+
+# engine class -> (resolver, description), memoised the first time each engine class is seen
+# keyed by class rather than class name, as the V0 and V1 engines are both called LLMEngine
+_ENGINE_MODEL_RESOLVERS = {}
+
+
+def _get_model_resolver(engine):
+    """find how to reach the underlying model of a vLLM engine, probing its attributes only once per engine class"""
+    engine_cls = type(engine)
+    if engine_cls in _ENGINE_MODEL_RESOLVERS:
+        return _ENGINE_MODEL_RESOLVERS[engine_cls]
+
+    resolver = None
+    if hasattr(engine, 'get_model'):
+        resolver = (_model_via_get_model, "get_model")
+    elif hasattr(engine, 'model_executor'):
+        model_executor = engine.model_executor
+        if hasattr(model_executor, 'driver_worker'):
+            resolver = (_model_via_driver_worker, "driver_worker")
+        elif hasattr(model_executor, 'workers'):
+            resolver = (_model_via_workers, "workers[0]")
+
+    _ENGINE_MODEL_RESOLVERS[engine_cls] = resolver
+    return resolver
+
+
 class ModelHandler:
     """load, download, and run models using vllm"""
     def __init__(
@@ -21,20 +66,53 @@ class ModelHandler:
         device='cuda',
         extract_activations=False,
         extract_layers=None,
+        offload_activations=False,
+        capture_dtype=None,
+        enable_prefix_caching=None,
+        block_size=None,
+        compile_model=False,
     ):
         """initialise the ModelHandler including loading the model
         
         extracted_activations: If this is True, all activations will be extracted from the model. Otherwise, no activations will be extracted.
-        extract_layers: List of layer indices to extract activations from
+        extract_layers: List of layer indices to extract activations from, required if extract_activations is True
+        offload_activations: If this is True, activations are copied to pinned CPU memory asynchronously (CUDA only)
+        capture_dtype: dtype extracted activations are stored in (e.g. torch.float16), defaulting to the model dtype
+        enable_prefix_caching: If this is True, vLLM reuses the KV cache of shared prompt prefixes across requests.
+            Defaults to on, and is always off with extract_activations (cached tokens never reach the hooks)
+        block_size: KV cache block size in tokens, the granularity at which prefixes are matched. Defaults to vLLM's platform default
+        compile_model: Experimental. If this is True, vLLM runs with enforce_eager and the hooked model forward is wrapped
+            in torch.compile instead (activation extraction only). Not benchmarked
         extract_activations: If this is True, all activations will be  from the model. Otherwise, no activations will be extracted.
         """
+        # fail before loading (or downloading) the model, rather than once the extractor is built afterwards
+        if extract_activations and not extract_layers:
+            raise ValueError("extract_layers must be a non-empty list of ints when extract_activations is True")
+        if compile_model and offload_activations:
+            raise ValueError("compile_model can't be combined with offload_activations")
+        
         self.local_files_only = local_files_only
         self.model_name = model_name
         self.extract_activations = extract_activations
         self.extract_layers = extract_layers
+        self.offload_activations = offload_activations
+        self.capture_dtype = capture_dtype
+        # tokens served from the prefix cache skip the forward pass, so their activations would never be captured
+        if enable_prefix_caching is None:
+            enable_prefix_caching = not extract_activations
+        elif enable_prefix_caching and extract_activations:
+            print("Warning: prefix caching is incompatible with activation extraction, disabling it")
+            enable_prefix_caching = False
+        self.enable_prefix_caching = enable_prefix_caching
+        self.block_size = block_size
+        self.compile_model = compile_model
         
         # activation extractor isn't created until after model initialisation
         self.activation_extractor = None
+        # set once check_model_in_cache finds the model, misses are re-checked as the model may be downloaded since
+        self._cache_hit = False
+        # monotonically increasing integer request IDs for activation extraction
+        self._req_counter = itertools.count()
         
         self.set_environ()
         self.set_huggingface_cache()
@@ -104,9 +182,19 @@ class ModelHandler:
         if not self.check_model_in_cache():
             print(f"Model not in cache, downloading to {self.HF_CACHE_DIR}")
         
+        llm_kwargs = {}
+        # only override vLLM's platform/backend default block size when asked to
+        if self.block_size is not None:
+            llm_kwargs["block_size"] = self.block_size
+        # our own torch.compile replaces vLLM's, rather than wrapping an already compiled model a second time
+        if self.compile_model and self.extract_activations:
+            llm_kwargs["enforce_eager"] = True
+        
         self.model = LLM(
             model = self.model_name,
-            download_dir = self.HF_CACHE_DIR
+            download_dir = self.HF_CACHE_DIR,
+            enable_prefix_caching = self.enable_prefix_caching,
+            **llm_kwargs,
         )
         
         # Now that model is loaded, we can safely import and create activation extractor
@@ -117,42 +205,27 @@ class ModelHandler:
             self.activation_extractor = ActivationExtractor(
                 extract_layers=self.extract_layers,
                 enabled=True,
+                offload_to_cpu=self.offload_activations,
+                capture_dtype=self.capture_dtype,
+                use_compile=self.compile_model,
             )
         
         # Register activation extraction hooks if enabled
         if self.activation_extractor is not None:
             # Access the underlying model through the engine
             engine = self.model.llm_engine
+            resolver = _get_model_resolver(engine)
+            model = None
+            if resolver is not None:
+                resolve, via = resolver
+                try:
+                    model = resolve(engine)
+                except AttributeError:
+                    model = None
             
-            # Try the new get_model() method (available in recent versions)
-            # This is the recommended approach going forward
-            if hasattr(engine, 'get_model'):
-                model = engine.get_model()
-                if model is not None:
-                    self.activation_extractor.register_model(model)
-                    print("Registered activation extraction hooks on model (via get_model)")
-            
-            # Legacy path for V0 engine and older versions
-            elif hasattr(engine, 'model_executor'):
-                # For V0 engine with model_executor
-                model_executor = engine.model_executor
-                
-                # Try to get driver_worker
-                if hasattr(model_executor, 'driver_worker'):
-                    worker = model_executor.driver_worker
-                    if hasattr(worker, 'model_runner') and hasattr(worker.model_runner, 'model'):
-                        model = worker.model_runner.model
-                        self.activation_extractor.register_model(model)
-                        print("Registered activation extraction hooks on model (via driver_worker)")
-                # Try workers array as fallback
-                elif hasattr(model_executor, 'workers'):
-                    workers = model_executor.workers
-                    if workers and len(workers) > 0:
-                        worker = workers[0]
-                        if hasattr(worker, 'model_runner') and hasattr(worker.model_runner, 'model'):
-                            model = worker.model_runner.model
-                            self.activation_extractor.register_model(model)
-                            print("Registered activation extraction hooks on model (via workers[0])")
+            if model is not None:
+                self.activation_extractor.register_model(model)
+                print(f"Registered activation extraction hooks on model (via {via})")
             
             # V1 engine path (note: V1 uses a different multiprocess architecture)
             # Direct model access is more limited in V1 due to the process separation
@@ -161,20 +234,22 @@ class ModelHandler:
 
 
     def check_model_in_cache(self):
-        """convert from 'org/model' HF format to 'models--org-model' format used in cache, and searching"""
-        cache_model_name = self.hf_to_cache_format(self.model_name)
-        cache_path = os.path.join(self.HF_CACHE_DIR, cache_model_name)
-        return os.path.exists(cache_path)
+        """convert from 'org/model' HF format to 'models--org-model' format used in cache, and searching
+        a hit is remembered, so once the model is in the cache the filesystem isn't checked again"""
+        if not self._cache_hit:
+            cache_model_name = self.hf_to_cache_format(self.model_name)
+            cache_path = os.path.join(self.HF_CACHE_DIR, cache_model_name)
+            self._cache_hit = os.path.exists(cache_path)
+        return self._cache_hit
     
 
     def list_models_in_cache(self):
         """list all model directories in the HF cache"""
-        if not os.path.exists(self.HF_CACHE_DIR):
+        try:
+            with os.scandir(self.HF_CACHE_DIR) as entries:
+                return [entry.name for entry in entries if entry.name.startswith("models--")]
+        except FileNotFoundError:
             return []
-        
-        all_items = os.listdir(self.HF_CACHE_DIR)
-        model_dirs = [item for item in all_items if item.startswith("models--")]
-        return model_dirs
     
 
     def hf_to_cache_format(self, model_name):
@@ -183,10 +258,25 @@ class ModelHandler:
     
 
     def generate(self, prompt, max_tokens=None, max_length=None, max_new_tokens=100,
-        temperature=1.0, top_p=1.0, top_k=0, repetition_penalty=1.0, stop=None, **kwargs):
+        temperature=1.0, top_p=1.0, top_k=0, repetition_penalty=1.0, stop=None, return_text=True, **kwargs):
         """
         Running inference using transformers-like API.
         Activations are stored in self.activation_extractor.activation_store
+        return_text: If this is False, the generated token ids are returned instead, and detokenisation is skipped
+            unless stop strings are given
+        """
+        return self.generate_batch(
+            [prompt], max_tokens=max_tokens, max_length=max_length, max_new_tokens=max_new_tokens,
+            temperature=temperature, top_p=top_p, top_k=top_k, repetition_penalty=repetition_penalty,
+            stop=stop, return_text=return_text, **kwargs,
+        )[0]
+
+    def generate_batch(self, prompts, max_tokens=None, max_length=None, max_new_tokens=100,
+        temperature=1.0, top_p=1.0, top_k=0, repetition_penalty=1.0, stop=None, return_text=True, **kwargs):
+        """
+        Running inference on a list of prompts in a single vLLM generate call, so they are batched together.
+        Returns the generated texts in prompt order, or the generated token ids if return_text is False.
+        Activations are stored in self.activation_extractor.activation_store, one request per prompt
         """
         # Handle max_length/max_new_tokens for transformers compatibility
         max_tokens = max_tokens or max_length or max_new_tokens
@@ -204,26 +294,35 @@ class ModelHandler:
         if stop is not None:
             params_dict["stop"] = stop
         
+        # Callers that only need activations can skip vLLM's incremental detokenisation,
+        # unless stop strings are given, which vLLM can only match against detokenised text
+        if not return_text and stop is None:
+            params_dict["detokenize"] = False
+        
         params_dict.update(kwargs)
         # Lazy import SamplingParams to avoid early vLLM module loading
+        # Built once and shared by every prompt in the batch
         from vllm import SamplingParams
         sampling_params = SamplingParams(**params_dict)
 
         # Set request context for activation extraction
         if self.activation_extractor is not None:
-            # Generate a simple request ID for this generation
-            request_id = f"req_{id(prompt)}"
-            self.activation_extractor.set_request_context([request_id])
+            # Generate a distinct integer request ID for each prompt in the batch
+            request_ids = [next(self._req_counter) for _ in prompts]
+            self.activation_extractor.set_request_context(request_ids, max_tokens=max_tokens)
 
-        outputs = self.model.generate([prompt], sampling_params)
+        outputs = self.model.generate(prompts, sampling_params)
 
-        generated_text = outputs[0].outputs[0].text
+        if return_text:
+            generated = [output.outputs[0].text for output in outputs]
+        else:
+            generated = [output.outputs[0].token_ids for output in outputs]
         
         # Clear request context after generation
         if self.activation_extractor is not None:
             self.activation_extractor.clear_request_context()
     
-        return generated_text
+        return generated
     
     def get_activation_store(self):
         """Get the activation store for probe computation."""